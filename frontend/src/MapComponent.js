@@ -243,7 +243,10 @@ const MapComponent = () => {
       if (!response.ok || data.error) {
         throw new Error(data.error || 'BNS model error');
       }
-      setBnsResults(data.records || []);
+      const columns = data.columns || [];
+      setBnsResults((data.data || []).map((row) => (
+        Object.fromEntries(columns.map((column, i) => [column, row[i]]))
+      )));
       if (!bnsModelInfo) {
         setBnsModelInfoLoading(true);
         try {
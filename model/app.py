@@ -1,20 +1,35 @@
 # app.py
 from __future__ import annotations
 
-import io
+import hashlib
 import os
-from functools import lru_cache
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from typing import BinaryIO
 
 import pandas as pd
 import numpy as np
-from fastapi import FastAPI, File, UploadFile
+import orjson
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from fastapi import FastAPI, File, Response, UploadFile
 import math
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from autogluon.tabular import TabularPredictor
 
 from bns_model import (
     load_bns_long_csv,
+    load_bns_feather,
     load_automl_model,
+    build_lag_cache,
+    LagCache,
     attach_lags_for_prediction,
+    model_features,
+    FEATURE_COLS,
     apply_mvp_adjustment,
 )
 
@@ -23,12 +38,51 @@ DATA_PATH = os.getenv(
     "BNS_LONG_CSV",
     os.path.join(BASE_DIR, "data", "bns_yield_2004_2024_long.csv"),
 )
+HIST_FEATHER_PATH = os.getenv(
+    "BNS_HIST_FEATHER",
+    os.path.join(BASE_DIR, "data", "bns_hist.feather"),
+)
 MODEL_PATH = os.getenv(
     "AUTOML_MODEL_PATH",
     os.path.join(BASE_DIR, "autogluon_bns_model"),
 )
 
-app = FastAPI(title="Yield Service (BNS baseline + NDVI adjustment)")
+# loaded once per worker process in lifespan()
+BNS_HIST: pd.DataFrame
+LAG_CACHE: LagCache
+BASELINE_MODEL: TabularPredictor
+# fixed evaluation set for /model-info (history doesn't change while the process runs)
+EVAL_DF: pd.DataFrame
+
+
+def _load_bns_hist() -> pd.DataFrame:
+    # precomputed Feather (precompute_bns.py) is used only if it was built from this exact CSV
+    if os.path.exists(HIST_FEATHER_PATH) and os.path.exists(DATA_PATH):
+        bns_hist = load_bns_feather(HIST_FEATHER_PATH, DATA_PATH)
+        if bns_hist is not None:
+            return bns_hist
+    return load_bns_long_csv(DATA_PATH)
+
+
+def _load_state() -> None:
+    global BNS_HIST, LAG_CACHE, BASELINE_MODEL, EVAL_DF
+    BNS_HIST = _load_bns_hist()
+    LAG_CACHE = build_lag_cache(BNS_HIST)
+    BASELINE_MODEL = load_automl_model(MODEL_PATH)
+    # same feature path (model_features) as training and /predict
+    EVAL_DF = model_features(BNS_HIST).assign(yield_t_ha=BNS_HIST["yield_t_ha"]).dropna()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # runs in every worker (see gunicorn.conf.py), so each one has its own warm model
+    _load_state()
+    # warm the report in the background so the first /model-info call is a cache hit
+    threading.Thread(target=_get_model_report_cached, daemon=True).start()
+    yield
+
+
+app = FastAPI(title="Yield Service (BNS baseline + NDVI adjustment)", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -38,8 +92,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-BNS_HIST = load_bns_long_csv(DATA_PATH)
-BASELINE_MODEL = load_automl_model(MODEL_PATH)
+# CSV upload parsing (Arrow multithreaded reader)
+CSV_READ_OPTIONS = pacsv.ReadOptions(use_threads=True, block_size=8 << 20)
+CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(column_types={"year": pa.int32()})
+HASH_CHUNK_SIZE = 1 << 20
+
+# /model-info report cache: (built_at monotonic seconds, report)
+MODEL_REPORT_TTL = float(os.getenv("MODEL_REPORT_TTL", "3600"))
+_REPORT_LOCK = threading.Lock()
+_REPORT_CACHE: tuple[float, dict] | None = None
 
 
 def _sanitize_value(value):
@@ -61,10 +122,49 @@ def _sanitize_record(record: dict) -> dict:
     return {key: _sanitize_value(val) for key, val in record.items()}
 
 
+def _sanitize_frame(df: pd.DataFrame) -> list[dict]:
+    """
+    Column-wise version of _sanitize_record: NaN/inf/NA -> None, then one to_dict pass.
+    """
+    out = df.copy(deep=False)
+    for col in out.columns:
+        series = out[col]
+        if pd.api.types.is_float_dtype(series.dtype):
+            mask = ~np.isfinite(series.to_numpy(dtype=np.float64, na_value=np.nan))
+        else:
+            mask = series.isna().to_numpy()
+        if mask.any():
+            values = series.to_numpy(dtype=object)
+            values[mask] = None
+            out[col] = values
+    return out.to_dict(orient="records")
+
+
+def _orjson_default(value):
+    if value is pd.NA or value is pd.NaT:
+        return None
+    if isinstance(value, (datetime, date)):  # incl. pd.Timestamp, which orjson doesn't take natively
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    # unexpected types in user data shouldn't take the endpoint down
+    return str(value)
+
+
+def _render_json(content) -> bytes:
+    """
+    orjson emits null for NaN/inf itself; pd.NA/NaT, timestamps and stray numpy scalars go through _orjson_default.
+    """
+    return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+class SafeORJSONResponse(ORJSONResponse):
+    def render(self, content) -> bytes:
+        return _render_json(content)
+
+
 def _build_model_report() -> dict:
     summary = BASELINE_MODEL.fit_summary(verbosity=0)
-    feature_cols = ["district", "year", "yield_lag1", "yield_lag2", "yield_roll3"]
-    eval_df = BNS_HIST[feature_cols + ["yield_t_ha"]].dropna().copy()
 
     errors = []
     best_model = None
@@ -90,20 +190,18 @@ def _build_model_report() -> dict:
             info = {}
         num_models_trained = info.get("num_models_trained") or len(info.get("model_info", {}) or {})
     try:
-        metrics = BASELINE_MODEL.evaluate(eval_df, silent=True, auxiliary_metrics=True)
+        metrics = BASELINE_MODEL.evaluate(EVAL_DF, silent=True, auxiliary_metrics=True)
     except Exception as exc:
         metrics = {}
         errors.append(f"metrics_error: {exc}")
 
     leaderboard = None
     try:
-        leaderboard = BASELINE_MODEL.leaderboard(eval_df, silent=True)
+        leaderboard = BASELINE_MODEL.leaderboard(EVAL_DF, extra_info=False, silent=True)
         if "score_val" in leaderboard.columns:
             leaderboard = leaderboard.sort_values("score_val", ascending=False)
         leaderboard = leaderboard.head(5)
-        leaderboard_records = [
-            _sanitize_record(rec) for rec in leaderboard.to_dict(orient="records")
-        ]
+        leaderboard_records = _sanitize_frame(leaderboard)
     except Exception as exc:
         leaderboard_records = []
         errors.append(f"leaderboard_error: {exc}")
@@ -156,38 +254,71 @@ def _build_model_report() -> dict:
     }
 
 
-@lru_cache(maxsize=1)
-def _get_model_report_cached() -> dict:
-    return _build_model_report()
+def _get_model_report_cached(refresh: bool = False) -> dict:
+    """
+    TTL cache for the model report; the lock makes concurrent cold/expired callers build it once.
+    """
+    global _REPORT_CACHE
+    requested_at = time.monotonic()
+    cached = _REPORT_CACHE
+    if not refresh and cached is not None and requested_at - cached[0] < MODEL_REPORT_TTL:
+        return cached[1]
+    with _REPORT_LOCK:
+        cached = _REPORT_CACHE
+        # re-check: someone may have (re)built it while we were waiting for the lock
+        if cached is not None and (
+            cached[0] >= requested_at or (not refresh and time.monotonic() - cached[0] < MODEL_REPORT_TTL)
+        ):
+            return cached[1]
+        report = _build_model_report()
+        _REPORT_CACHE = (time.monotonic(), report)
+        return report
 
 @app.get("/health")
 def health():
     return {"status": "ok", "bns_rows": len(BNS_HIST)}
 
-@app.post("/predict")
-async def predict(file: UploadFile = File(...), mvp_adjust: bool = True):
-    """
-    Принимает CSV с полигонами.
-    Требует: district, year + твои поля NDVI/темп (для корректировки, опционально)
-    Возвращает records с yield_pred_base_t_ha и yield_pred_t_ha.
-    """
-    content = await file.read()
-    df = pd.read_csv(io.BytesIO(content))
+def _hash_upload(source: BinaryIO) -> bytes:
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    source.seek(0)
+    return digest.digest()
+
+
+def _predict_payload(source: BinaryIO, mvp_adjust: bool) -> dict:
+    # read the spooled upload directly (no full bytes copy); read_csv infers column types
+    # over the whole file, unlike open_csv which fixes them from the first block
+    try:
+        table = pacsv.read_csv(
+            source,
+            read_options=CSV_READ_OPTIONS,
+            convert_options=CSV_CONVERT_OPTIONS,
+        )
+    except pa.ArrowInvalid as exc:
+        return {"error": f"Failed to parse CSV: {exc}"}
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
 
     # district
     if "district" not in df.columns:
         return {"error": "CSV must include 'district' column (e.g. 'Целиноградский район')."}
+    if "year" not in df.columns:
+        return {"error": "CSV must include 'year' column."}
 
-    
-    df["year"] = pd.to_numeric(df["year"], errors="coerce")
+    # year is already typed as int32 by Arrow; only drop empty cells
     df = df.dropna(subset=["year"]).copy()
     df["year"] = df["year"].astype(int)
 
-    df2 = attach_lags_for_prediction(BNS_HIST, df)
+    df2 = attach_lags_for_prediction(LAG_CACHE, df)
 
     # baseline prediction
-    needed_cols = ["district", "year", "yield_lag1", "yield_lag2", "yield_roll3"]
-    df2["yield_pred_base_t_ha"] = BASELINE_MODEL.predict(df2[needed_cols]).astype(float)
+    # rows sharing the same (district, year, lags) get identical predictions: predict unique rows only
+    features = model_features(df2)
+    inverse = features.groupby(FEATURE_COLS, sort=False, dropna=False).ngroup().to_numpy()
+    _, first_idx = np.unique(inverse, return_index=True)
+    unique_features = features.iloc[first_idx].reset_index(drop=True)
+    unique_preds = np.asarray(BASELINE_MODEL.predict(unique_features, as_pandas=False), dtype=np.float64)
+    df2["yield_pred_base_t_ha"] = unique_preds[inverse]
 
     # optional MVP adjustment using NDVI/temp
     if mvp_adjust:
@@ -195,19 +326,48 @@ async def predict(file: UploadFile = File(...), mvp_adjust: bool = True):
     else:
         df2["yield_pred_t_ha"] = df2["yield_pred_base_t_ha"]
 
-    # FastAPI JSON can't serialize NaN/inf, replace with None
-    records = df2.to_dict(orient="records")
-
-    clean_records = [_sanitize_record(rec) for rec in records]
+    # column-oriented payload; NaN/inf/NA -> null is handled by the orjson response
+    payload = df2.to_dict(orient="split", index=False)
 
     return {
-        "n_rows": len(clean_records),
-        "records": clean_records,
+        "n_rows": len(payload["data"]),
+        "columns": payload["columns"],
+        "data": payload["data"],
     }
 
 
+# rendered /predict responses keyed on (upload SHA-256, mvp_adjust), oldest evicted first
+PREDICT_CACHE_SIZE = 128
+_PREDICT_CACHE: OrderedDict[tuple[bytes, bool], bytes] = OrderedDict()
+_PREDICT_CACHE_LOCK = threading.Lock()
+
+
+@app.post("/predict", response_class=SafeORJSONResponse)
+async def predict(file: UploadFile = File(...), mvp_adjust: bool = True, no_cache: bool = False):
+    """
+    Принимает CSV с полигонами.
+    Требует: district, year + твои поля NDVI/темп (для корректировки, опционально)
+    Возвращает таблицу {n_rows, columns, data} с yield_pred_base_t_ha и yield_pred_t_ha
+    (data — список строк в порядке columns).
+    Одинаковые загрузки отдаются из кэша (по SHA-256 файла), no_cache=1 — пересчитать без кэша.
+    """
+    if no_cache:
+        return Response(content=_render_json(_predict_payload(file.file, mvp_adjust)), media_type="application/json")
+
+    key = (_hash_upload(file.file), mvp_adjust)
+    with _PREDICT_CACHE_LOCK:
+        body = _PREDICT_CACHE.get(key)
+        if body is not None:
+            _PREDICT_CACHE.move_to_end(key)
+    if body is None:
+        body = _render_json(_predict_payload(file.file, mvp_adjust))
+        with _PREDICT_CACHE_LOCK:
+            _PREDICT_CACHE[key] = body
+            if len(_PREDICT_CACHE) > PREDICT_CACHE_SIZE:
+                _PREDICT_CACHE.popitem(last=False)
+    return Response(content=body, media_type="application/json")
+
+
 @app.get("/model-info")
 def model_info(refresh: bool = False):
-    if refresh:
-        _get_model_report_cached.cache_clear()
-    return _get_model_report_cached()
+    return _get_model_report_cached(refresh=refresh)
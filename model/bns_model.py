@@ -1,8 +1,14 @@
 # bns_model.py
 from __future__ import annotations
 
+import os
+from typing import NamedTuple
+
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+from numba import njit, prange
+from pyarrow import feather
 
 from autogluon.tabular import TabularPredictor
 
@@ -11,7 +17,7 @@ def load_bns_long_csv(path: str) -> pd.DataFrame:
     """
     Expected columns: district, year, yield_c_per_ha
     """
-    df = pd.read_csv(path)
+    df = pd.read_csv(path, engine="pyarrow")
     required = {"district", "year", "yield_c_per_ha"}
     missing = required - set(df.columns)
     if missing:
@@ -26,20 +32,87 @@ def load_bns_long_csv(path: str) -> pd.DataFrame:
     df["yield_t_ha"] = df["yield_c_per_ha"] / 10.0
     df["year"] = df["year"].astype(int)
 
-    # lags/rolling (no leakage: shift(1))
+    # lags/rolling (no leakage: only previous years of the same district)
     df = df.sort_values(["district", "year"]).reset_index(drop=True)
-    df["yield_lag1"] = df.groupby("district")["yield_t_ha"].shift(1)
-    df["yield_lag2"] = df.groupby("district")["yield_t_ha"].shift(2)
-    df["yield_roll3"] = (
-        df.groupby("district")["yield_t_ha"]
-          .shift(1)
-          .rolling(3, min_periods=1)
-          .mean()
-          .reset_index(level=0, drop=True)
-    )
+    lag1, lag2, roll3 = _history_lags(df["district"].to_numpy(), df["yield_t_ha"].to_numpy(dtype=np.float64))
+    df["yield_lag1"] = lag1
+    df["yield_lag2"] = lag2
+    df["yield_roll3"] = roll3
     return df
 
 
+def _history_lags(districts: np.ndarray, yields: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    lag1/lag2/roll3 in one pass over rows sorted by (district, year); yields must not contain NaN.
+    """
+    n = len(yields)
+    idx = np.arange(n)
+    # first row index of each row's district group
+    starts = np.flatnonzero(np.r_[n > 0, districts[1:] != districts[:-1]])
+    group_start = np.repeat(starts, np.diff(np.r_[starts, n]))
+
+    lag1 = np.where(idx - 1 >= group_start, yields[np.maximum(idx - 1, 0)], np.nan)
+    lag2 = np.where(idx - 2 >= group_start, yields[np.maximum(idx - 2, 0)], np.nan)
+
+    # roll3: mean of up to 3 previous yields in the group (min_periods=1)
+    csum = np.r_[0.0, np.cumsum(yields)]
+    lo = np.maximum(group_start, idx - 3)
+    count = idx - lo
+    roll3 = np.divide(csum[idx] - csum[lo], count, out=np.full(n, np.nan), where=count > 0)
+    return lag1, lag2, roll3
+
+
+FEATURE_COLS = ["district", "year", "yield_lag1", "yield_lag2", "yield_roll3"]
+LAG_COLS = ["yield_lag1", "yield_lag2", "yield_roll3"]
+
+
+def model_features(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    AutoML feature frame; lags as float32 (the tree models split on float32 anyway).
+    """
+    out = df[FEATURE_COLS].copy()
+    out[LAG_COLS] = out[LAG_COLS].astype(np.float32)
+    return out
+
+
+# bump when load_bns_long_csv's derived columns change, so older Feather files are rebuilt
+BNS_FEATHER_VERSION = 1
+
+
+def _bns_source_metadata(csv_path: str) -> dict[bytes, bytes]:
+    st = os.stat(csv_path)
+    meta = {
+        "bns_source_csv": os.path.abspath(csv_path),
+        "bns_source_size": str(st.st_size),
+        "bns_source_mtime_ns": str(st.st_mtime_ns),
+        "bns_format_version": str(BNS_FEATHER_VERSION),
+    }
+    return {k.encode(): v.encode() for k, v in meta.items()}
+
+
+def save_bns_feather(bns_df: pd.DataFrame, path: str, csv_path: str) -> None:
+    """
+    Store post-processed BNS history (output of load_bns_long_csv(csv_path)) as uncompressed Feather,
+    with the source CSV (path, size, mtime) and format version in the schema metadata.
+    """
+    table = pa.Table.from_pandas(bns_df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **_bns_source_metadata(csv_path)})
+    feather.write_feather(table, path, compression="uncompressed")
+
+
+def load_bns_feather(path: str, csv_path: str) -> pd.DataFrame | None:
+    """
+    Memory-map BNS history written by save_bns_feather.
+    Returns None if it wasn't built from csv_path as it is now, or by another format version.
+    """
+    table = feather.read_table(path, memory_map=True)
+    meta = table.schema.metadata or {}
+    expected = _bns_source_metadata(csv_path)
+    if any(meta.get(key) != value for key, value in expected.items()):
+        return None
+    return table.to_pandas()
+
+
 def train_automl_model(
     bns_df: pd.DataFrame,
     save_path: str = "autogluon_bns_model",
@@ -49,10 +122,10 @@ def train_automl_model(
     """
     AutoML: district + year + lags -> yield_t_ha (regression)
     """
-    feature_cols = ["district", "year", "yield_lag1", "yield_lag2", "yield_roll3"]
     target_col = "yield_t_ha"
 
-    train_data = bns_df[feature_cols + [target_col]].copy()
+    train_data = model_features(bns_df)
+    train_data[target_col] = bns_df[target_col]
 
     predictor = TabularPredictor(
         label=target_col,
@@ -68,69 +141,138 @@ def train_automl_model(
 
 
 def load_automl_model(path: str) -> TabularPredictor:
-    return TabularPredictor.load(path)
+    """
+    Load the predictor and keep the best model (with its ensemble members) in memory,
+    otherwise AutoGluon unpickles the models from disk on every predict call.
+    """
+    predictor = TabularPredictor.load(path)
+    persist = getattr(predictor, "persist", None) or predictor.persist_models  # < 1.0: persist_models
+    persist(models="best")
+    return predictor
+
+
+class LagCache(NamedTuple):
+    district_dtype: pd.CategoricalDtype  # category code == district slot in offsets
+    offsets: np.ndarray  # (n_districts + 1,): district d owns rows offsets[d]:offsets[d + 1]
+    years: np.ndarray  # (n_hist,): BNS years, sorted within each district
+    yields: np.ndarray  # (n_hist,): yield_t_ha aligned with years
+
+
+@njit(parallel=True, cache=True)
+def compute_lags(district_ids, years, offsets, hist_years, hist_yields, out_lag1, out_lag2, out_roll3):
+    """
+    Row-wise lag assembly: binary search of the row year in its district's history slice,
+    lags come from the history years strictly before it (district code -1 = unknown district).
+    Not fastmath: the NaN checks below must survive compilation.
+    """
+    for i in prange(district_ids.shape[0]):
+        out_lag1[i] = np.nan
+        out_lag2[i] = np.nan
+        out_roll3[i] = np.nan
+        did = district_ids[i]
+        if did < 0 or np.isnan(years[i]):
+            continue
+        start = offsets[did]
+        end = offsets[did + 1]
+        k = start + np.searchsorted(hist_years[start:end], years[i])
+        if k - 1 >= start:
+            out_lag1[i] = hist_yields[k - 1]
+        if k - 2 >= start:
+            out_lag2[i] = hist_yields[k - 2]
+        lo = max(start, k - 3)
+        if k > lo:
+            out_roll3[i] = hist_yields[lo:k].mean()
+
+
+def build_district_dtype(bns_hist: pd.DataFrame) -> pd.CategoricalDtype:
+    """
+    Fixed district vocabulary from BNS history; unknown districts cast to NaN (code -1).
+    """
+    return pd.CategoricalDtype(categories=sorted(bns_hist["district"].unique()), ordered=False)
+
+
+def build_lag_cache(bns_hist: pd.DataFrame) -> LagCache:
+    """
+    Pack the (sorted) BNS history into contiguous per-district year/yield arrays and warm up the lag kernel.
+    """
+    district_dtype = build_district_dtype(bns_hist)
+    codes = bns_hist["district"].astype(district_dtype).cat.codes.to_numpy()
+    years = bns_hist["year"].to_numpy(dtype=np.float64)
+    order = np.lexsort((years, codes))
+    counts = np.bincount(codes, minlength=len(district_dtype.categories))
+    offsets = np.r_[0, np.cumsum(counts)].astype(np.int64)
+    years = np.ascontiguousarray(years[order])
+    yields = np.ascontiguousarray(bns_hist["yield_t_ha"].to_numpy(dtype=np.float64)[order])
+
+    # compile once here so the first request doesn't pay for the JIT
+    dummy = np.empty(1, dtype=np.float64)
+    compute_lags(np.full(1, -1, dtype=np.int64), dummy.copy(), offsets, years, yields, dummy, dummy.copy(), dummy.copy())
+
+    return LagCache(district_dtype, offsets, years, yields)
 
 
-def attach_lags_for_prediction(bns_hist: pd.DataFrame, poly_df: pd.DataFrame) -> pd.DataFrame:
+def attach_lags_for_prediction(lag_cache: LagCache, poly_df: pd.DataFrame) -> pd.DataFrame:
     """
-    poly_df must contain district and year. We append rows to history and compute lag1/lag2/roll3.
+    poly_df must contain district and year. Lags come from the cached BNS history of the district
+    (years before the row year; gaps carry the latest years forward), unknown districts get NaN.
     """
     need = {"district", "year"}
     missing = need - set(poly_df.columns)
     if missing:
         raise ValueError(f"Polygon dataset missing columns: {sorted(missing)}")
 
-    base = bns_hist[["district", "year", "yield_t_ha"]].copy()
-    tmp = poly_df[["district", "year"]].copy()
-    tmp["yield_t_ha"] = np.nan
-
-    comb = pd.concat([base, tmp], ignore_index=True)
-    comb["district"] = comb["district"].astype(str).str.strip()
-    comb["year"] = pd.to_numeric(comb["year"], errors="coerce")
-    comb = comb.dropna(subset=["district", "year"]).copy()
-    comb["year"] = comb["year"].astype(int)
-
-    comb = comb.sort_values(["district", "year"]).reset_index(drop=True)
-
-    comb["yield_lag1"] = comb.groupby("district")["yield_t_ha"].shift(1)
-    comb["yield_lag2"] = comb.groupby("district")["yield_t_ha"].shift(2)
-    comb["yield_roll3"] = (
-        comb.groupby("district")["yield_t_ha"]
-            .shift(1)
-            .rolling(3, min_periods=1)
-            .mean()
-            .reset_index(level=0, drop=True)
-    )
+    # categorical codes index straight into the cached history slices (-1 for unknown districts)
+    districts = poly_df["district"]
+    if not pd.api.types.is_string_dtype(districts.dtype):
+        districts = districts.astype(str)
+    districts = districts.str.strip().astype(lag_cache.district_dtype)
+    district_ids = districts.cat.codes.to_numpy(dtype=np.int64)
+    years = pd.to_numeric(poly_df["year"], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+
+    n = len(poly_df)
+    lag1 = np.empty(n, dtype=np.float64)
+    lag2 = np.empty(n, dtype=np.float64)
+    roll3 = np.empty(n, dtype=np.float64)
+    compute_lags(district_ids, years, lag_cache.offsets, lag_cache.years, lag_cache.yields, lag1, lag2, roll3)
 
-    # return only prediction rows (yield_t_ha is NaN)
-    pred_rows = comb[comb["yield_t_ha"].isna()][["district", "year", "yield_lag1", "yield_lag2", "yield_roll3"]]
-    out = poly_df.merge(pred_rows, on=["district", "year"], how="left")
+    out = poly_df.copy()
+    out["yield_lag1"] = lag1
+    out["yield_lag2"] = lag2
+    out["yield_roll3"] = roll3
     return out
 
 
+def _numeric_column(df: pd.DataFrame, col: str) -> np.ndarray:
+    if col not in df.columns:
+        return np.full(len(df), np.nan, dtype=np.float64)
+    values = df[col]
+    if not pd.api.types.is_numeric_dtype(values.dtype):
+        values = pd.to_numeric(values, errors="coerce")
+    return values.to_numpy(dtype=np.float64, na_value=np.nan)
+
+
 def apply_mvp_adjustment(poly_df: pd.DataFrame) -> pd.DataFrame:
     """
-    MVP adjustment using NDVI/temperature.
+    MVP adjustment using NDVI/temperature. Adds columns to poly_df in place and returns it.
     """
-    out = poly_df.copy()
-
     # derived
-    if "ndvi_range" not in out.columns and {"ndvi_max", "ndvi_min"} <= set(out.columns):
-        out["ndvi_range"] = pd.to_numeric(out["ndvi_max"], errors="coerce") - pd.to_numeric(out["ndvi_min"], errors="coerce")
+    if "ndvi_range" not in poly_df.columns and {"ndvi_max", "ndvi_min"} <= set(poly_df.columns):
+        poly_df["ndvi_range"] = _numeric_column(poly_df, "ndvi_max") - _numeric_column(poly_df, "ndvi_min")
 
     # coefficients
     k_ndvi = 0.6
     k_temp = 0.02
 
-    ndvi_mean = pd.to_numeric(out.get("ndvi_mean"), errors="coerce")
-    gee_air = pd.to_numeric(out.get("gee_air_temp_mean"), errors="coerce")
+    ndvi_mean = _numeric_column(poly_df, "ndvi_mean")
+    gee_air = _numeric_column(poly_df, "gee_air_temp_mean")
 
-    ndvi_effect = k_ndvi * (ndvi_mean - 0.2)  # 0.2 is a baseline
-    temp_effect = k_temp * gee_air
-
-    # clamp adjustment
-    adj = (ndvi_effect.fillna(0) + temp_effect.fillna(0)).clip(-0.5, 0.5)
-    out["yield_adjustment_t_ha"] = adj
-    out["yield_pred_t_ha"] = out["yield_pred_base_t_ha"] + out["yield_adjustment_t_ha"]
+    # 0.2 is a NDVI baseline; missing inputs contribute nothing; clamp adjustment
+    adj = np.clip(
+        k_ndvi * np.nan_to_num(ndvi_mean - 0.2) + k_temp * np.nan_to_num(gee_air),
+        -0.5,
+        0.5,
+    )
+    poly_df["yield_adjustment_t_ha"] = adj
+    poly_df["yield_pred_t_ha"] = _numeric_column(poly_df, "yield_pred_base_t_ha") + adj
 
-    return out
+    return poly_df
@@ -0,0 +1,39 @@
+# gunicorn.conf.py
+# Production entrypoint (Linux): gunicorn -c gunicorn.conf.py app:app
+# One single-threaded worker per core; every worker loads its own model in the FastAPI lifespan.
+import os
+
+# set before workers import numpy/numba/sklearn so they don't oversubscribe the cores
+for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMBA_NUM_THREADS"):
+    os.environ.setdefault(var, "1")
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+# no preload_app: forking after numba/OpenMP thread pools are started is unsafe
+preload_app = False
+
+
+# worker.age -> pinned core; lives in the arbiter, so replaced workers reuse the freed core
+_WORKER_CPUS: dict[int, int] = {}
+
+
+def pre_fork(server, worker):
+    # pick the least-used core before forking (runs in the arbiter)
+    if hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        used = list(_WORKER_CPUS.values())
+        worker.cpu = min(cpus, key=used.count)
+        _WORKER_CPUS[worker.age] = worker.cpu
+
+
+def post_fork(server, worker):
+    # pin the new worker to the core chosen in pre_fork
+    cpu = getattr(worker, "cpu", None)
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+
+
+def child_exit(server, worker):
+    # runs in the arbiter when a worker exits: free its core
+    _WORKER_CPUS.pop(worker.age, None)
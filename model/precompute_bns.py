@@ -0,0 +1,33 @@
+# precompute_bns.py
+from __future__ import annotations
+
+import argparse
+import os
+
+from bns_model import load_bns_long_csv, save_bns_feather
+
+
+def parse_args() -> argparse.Namespace:
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Precompute BNS history (lags/rolling) into a Feather file.")
+    parser.add_argument(
+        "--data",
+        default=os.getenv("BNS_LONG_CSV", os.path.join(base_dir, "data", "bns_yield_2004_2024_long.csv")),
+        help="Path to BNS long CSV (district, year, yield_c_per_ha)",
+    )
+    parser.add_argument(
+        "--out",
+        default=os.getenv("BNS_HIST_FEATHER", os.path.join(base_dir, "data", "bns_hist.feather")),
+        help="Path to write the Feather file",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    bns_df = load_bns_long_csv(args.data)
+    save_bns_feather(bns_df, args.out, args.data)
+
+
+if __name__ == "__main__":
+    main()